@@ -1,16 +1,15 @@
 import streamlit as st
 import pandas as pd
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import json
+import hashlib
 import unicodedata
 import time
 import io
-import matplotlib.pyplot as plt
-from docx import Document
-from docx.shared import Inches, Pt, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
+import os
+import shutil
+import threading
+# Thư viện nặng (gspread/oauth2client, matplotlib, python-docx) được import
+# bên trong hàm sử dụng để trang HS/PH không phải nạp chúng khi khởi động.
 
 # ==============================================================================
 # 1. CẤU HÌNH & GIAO DIỆN
@@ -43,10 +42,39 @@ st.markdown("""
 # 2. XỬ LÝ KẾT NỐI & CORE DATA FUNCTIONS
 # ==============================================================================
 SHEET_ID = "14E2JfVyOhGMa7T1VA44F31IaPMWIVIPRApo4B-ipDLk"
+# Thư mục dữ liệu cục bộ (OKR_*_DIR) tính từ thư mục chứa app.py, không phụ thuộc thư mục hiện hành
+# (cron chạy jobs.py từ thư mục khác vẫn ghi đúng chỗ dashboard đọc)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SHEET_HEADERS = {
+    "Users": ["Email", "Password", "HoTen", "VaiTro", "TenLop"],
+    "Classes": ["TenLop", "EmailGVCN", "SiSo"],
+    "Periods": ["ID", "TenDot", "TrangThai"],
+    "Relationships": ["Email_HocSinh", "Email_PhuHuynh"],
+    "OKRs": ["ID", "Email_HocSinh", "ID_Dot", "MucTieu", "KetQuaThenChot", "TienDo", "TrangThai", "NhanXet_GV", "NhanXet_PH", "MinhChung", "TargetValue", "ActualValue", "Unit", "DeleteRequest"],
+    "FinalReviews": ["Email_HocSinh", "ID_Dot", "NhanXet_GV", "NhanXet_PH", "DaGui_PH"]
+}
+
+# OKRs được tách theo đợt: mỗi ID_Dot một worksheet "OKRs_<ID_Dot>".
+# Bảng "OKRs" cũ chỉ còn dùng cho các đợt chưa tách (xem migrate_okrs_to_partitions).
+OKR_SHEET = "OKRs"
+
+def okr_partition_name(period_id):
+    return f"{OKR_SHEET}_{int(period_id)}"
+
+def is_okr_partition(sheet_name):
+    prefix = OKR_SHEET + "_"
+    return sheet_name.startswith(prefix) and sheet_name[len(prefix):].isdigit()
+
+def base_table(sheet_name):
+    """Tên bảng gốc (schema) của một worksheet, vd. OKRs_3 -> OKRs"""
+    return OKR_SHEET if is_okr_partition(sheet_name) else sheet_name
 
 @st.cache_resource
 def init_connection():
     try:
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
         scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
         creds_dict = json.loads(st.secrets["service_account"]["info"])
         creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
@@ -56,48 +84,83 @@ def init_connection():
         st.error(f"Lỗi kết nối API Google: {e}")
         return None
 
-def get_worksheet(sheet_name):
+def get_worksheet(sheet_name, raise_errors=False):
     client = init_connection()
     if not client: return None
+    import gspread
     try:
         sh = client.open_by_key(SHEET_ID)
         return sh.worksheet(sheet_name)
     except gspread.WorksheetNotFound:
+        if sheet_name == OKR_SHEET:
+            # Bảng OKRs cũ đã tách (danh sách worksheet đang lưu đã cũ) -> không tạo lại
+            refresh_sheet_titles()
+            return None
         # Tự động tạo tab nếu thiếu
         sh = client.open_by_key(SHEET_ID)
         ws = sh.add_worksheet(title=sheet_name, rows=100, cols=20)
-        headers = {
-            "Users": ["Email", "Password", "HoTen", "VaiTro", "TenLop"],
-            "Classes": ["TenLop", "EmailGVCN", "SiSo"],
-            "Periods": ["ID", "TenDot", "TrangThai"],
-            "Relationships": ["Email_HocSinh", "Email_PhuHuynh"],
-            "OKRs": ["ID", "Email_HocSinh", "ID_Dot", "MucTieu", "KetQuaThenChot", "TienDo", "TrangThai", "NhanXet_GV", "NhanXet_PH", "MinhChung", "TargetValue", "ActualValue", "Unit", "DeleteRequest"],
-            "FinalReviews": ["Email_HocSinh", "ID_Dot", "NhanXet_GV", "NhanXet_PH", "DaGui_PH"]
-        }
-        if sheet_name in headers:
-            ws.append_row(headers[sheet_name])
+        refresh_sheet_titles()
+        if base_table(sheet_name) in SHEET_HEADERS:
+            ws.append_row(SHEET_HEADERS[base_table(sheet_name)])
             if sheet_name == "Users":
                 ws.append_row(["admin@school.com", "123", "Quản Trị Viên", "Admin", ""])
         return ws
     except Exception as e:
+        if raise_errors: raise
         st.error(f"Lỗi truy cập dữ liệu: {e}")
         return None
 
-@st.cache_data(ttl=10)
-def load_data(sheet_name):
-    """Đọc dữ liệu an toàn với caching"""
-    ws = get_worksheet(sheet_name)
-    if not ws: return pd.DataFrame()
+@st.cache_data(ttl=60, show_spinner=False)
+def get_sheet_titles():
+    """Danh sách tên worksheet hiện có (đọc live, lưu kèm snapshot). Trả về None nếu API lỗi"""
+    client = init_connection()
+    if not client: return None
     try:
+        titles = [ws.title for ws in client.open_by_key(SHEET_ID).worksheets()]
+    except Exception:
+        return None
+    save_sheet_titles(titles)
+    return titles
+
+def refresh_sheet_titles():
+    """Đọc lại danh sách worksheet sau khi thêm/đổi tên (cập nhật cả bản lưu)"""
+    get_sheet_titles.clear()
+    return get_sheet_titles()
+
+# --- KIỂU DỮ LIỆU GỌN (SCHEMA) ---
+# ID & cờ -> số nguyên nhỏ; cột lặp nhiều giá trị -> category
+INT_COLUMNS = {'ID': 'int32', 'ID_Dot': 'int16', 'SiSo': 'int16', 'DeleteRequest': 'int8', 'DaGui_PH': 'int8'}
+FLOAT_COLUMNS = ['TargetValue', 'ActualValue']
+CATEGORY_COLUMNS = ['Email', 'Email_HocSinh', 'EmailGVCN', 'TenLop', 'TrangThai', 'VaiTro', 'Unit']
+# Cột văn bản dài ít dùng -> tách riêng, chỉ đọc khi cần (load_text_columns)
+TEXT_COLUMNS = {"OKRs": ['NhanXet_GV', 'NhanXet_PH', 'MinhChung']}
+
+def apply_schema(sheet_name, df):
+    """Ép kiểu theo schema để giảm bộ nhớ"""
+    for col in df.columns:
+        if col in INT_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(INT_COLUMNS[col])
+        elif col in FLOAT_COLUMNS:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype('float64')
+        elif col in CATEGORY_COLUMNS:
+            df[col] = df[col].fillna("").astype(str).astype('category')
+    return df
+
+def drop_text_columns(sheet_name, df):
+    cols = [c for c in TEXT_COLUMNS.get(base_table(sheet_name), []) if c in df.columns]
+    return df.drop(columns=cols) if cols else df
+
+def fetch_sheet(sheet_name):
+    """Đọc trực tiếp từ Google Sheets (đủ cột, đã ép kiểu). Trả về None nếu API lỗi"""
+    if not init_connection():
+        record_read(connected=False)
+        return None
+    try:
+        ws = get_worksheet(sheet_name, raise_errors=True)
+        if ws is None: return None  # bảng OKRs cũ không còn
         data = ws.get_all_records()
         df = pd.DataFrame(data)
         
-        # Xử lý numeric columns
-        numeric_cols = ['ID', 'ID_Dot', 'TargetValue', 'ActualValue', 'DeleteRequest', 'SiSo', 'DaGui_PH']
-        for col in numeric_cols:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-        
         # Fix cột Users
         if sheet_name == "Users":
             if 'ClassID' in df.columns and 'TenLop' not in df.columns:
@@ -108,17 +171,215 @@ def load_data(sheet_name):
             if 'Password' in df.columns:
                 df['Password'] = df['Password'].astype(str)
             
-        return df
+        df = apply_schema(sheet_name, df)
+    except Exception as e:
+        record_read(error=e)
+        return None
+    record_read()
+    return df
+
+# --- SNAPSHOT CỤC BỘ (KHỞI ĐỘNG NHANH & CHẾ ĐỘ CHỈ ĐỌC) ---
+SNAPSHOT_DIR = os.path.join(APP_DIR, os.environ.get("OKR_SNAPSHOT_DIR", ".okr_snapshot"))
+SNAPSHOT_VERSION = 2
+
+SHEET_TITLES_PATH = os.path.join(SNAPSHOT_DIR, "sheet_titles.json")
+
+def _snapshot_paths(sheet_name):
+    base = os.path.join(SNAPSHOT_DIR, sheet_name)
+    return base + ".parquet", base + ".json"
+
+def save_sheet_titles(titles):
+    """Lưu danh sách worksheet để định tuyến OKR khi khởi động/mất kết nối mà không cần gọi API"""
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        tmp = f"{SHEET_TITLES_PATH}.tmp{threading.get_ident()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(titles, f, ensure_ascii=False)
+        os.replace(tmp, SHEET_TITLES_PATH)
+    except OSError as e:
+        print(f"Skip sheet titles: {e}")
+
+def load_sheet_titles():
+    try:
+        with open(SHEET_TITLES_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_snapshot(sheet_name, df):
+    """Ghi snapshot dạng cột (Parquet) + metadata schema/version, ghi nguyên tử"""
+    data_path, meta_path = _snapshot_paths(sheet_name)
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        out = df.copy()
+        # Cột object từ Sheets có thể lẫn số/chữ -> chuẩn hoá về chuỗi để Parquet ghi được
+        for col in out.columns:
+            if out[col].dtype == object:
+                out[col] = out[col].map(lambda v: "" if v is None else str(v))
+        meta = {
+            "version": SNAPSHOT_VERSION, "sheet": sheet_name,
+            "saved_at": time.time(), "rows": len(out),
+            "schema": {c: str(t) for c, t in out.dtypes.items()},
+        }
+        out.to_parquet(data_path + ".tmp", index=False)
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(data_path + ".tmp", data_path)
+        os.replace(meta_path + ".tmp", meta_path)
+        return True
     except Exception as e:
-        return pd.DataFrame()
+        print(f"Skip snapshot {sheet_name}: {e}")
+        return False
+
+def load_snapshot(sheet_name, columns=None, exclude=()):
+    """Đọc snapshot nếu hợp lệ (đúng version & schema), ngược lại trả về None.
+    Chỉ đọc các cột cần (columns / exclude) nhờ định dạng cột."""
+    data_path, meta_path = _snapshot_paths(sheet_name)
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != SNAPSHOT_VERSION: return None
+        schema_cols = list(meta.get("schema", {}).keys())
+        wanted = [c for c in (columns or schema_cols) if c not in exclude]
+        if any(c not in schema_cols for c in wanted): return None
+        return pd.read_parquet(data_path, columns=wanted)
+    except Exception:
+        return None
+
+@st.cache_resource
+def get_runtime_state():
+    """Trạng thái dùng chung trong tiến trình: bảng đã đọc live, cờ offline, luồng làm mới"""
+    return {'warm': set(), 'offline': False, 'failures': 0, 'refreshing': False, 'lock': threading.Lock(),
+            'progress_lock': threading.Lock(), 'live_only': False}
+
+OFFLINE_AFTER_FAILURES = 3  # Số lần đọc lỗi liên tiếp trước khi chuyển sang chỉ đọc
+REFRESH_PAUSE_SEC = 1.0     # Giãn cách giữa các bảng khi làm mới nền (tránh 429)
+
+def is_quota_error(e):
+    return '429' in str(e) or 'quota' in str(e).lower()
+
+def record_read(error=None, connected=True):
+    """Cập nhật cờ offline sau mỗi lần đọc live. Mất kết nối -> chỉ đọc ngay;
+    lỗi khác -> chỉ đọc sau OFFLINE_AFTER_FAILURES lần liên tiếp; lỗi quota (429) không tính."""
+    state = get_runtime_state()
+    if not connected:
+        state['offline'] = True
+    elif error is None:
+        state['failures'] = 0
+        state['offline'] = False
+    elif not is_quota_error(error):
+        state['failures'] += 1
+        if state['failures'] >= OFFLINE_AFTER_FAILURES: state['offline'] = True
+
+def snapshot_sheet_names():
+    """Các bảng cần làm mới: bảng gốc (trừ OKRs cũ) + mọi bảng đã có snapshot (gồm phân vùng OKRs)"""
+    names = [n for n in SHEET_HEADERS if n != OKR_SHEET]
+    try:
+        names += sorted(f[:-8] for f in os.listdir(SNAPSHOT_DIR) if f.endswith(".parquet") and f[:-8] not in names)
+    except OSError:
+        pass
+    return names
+
+def delete_snapshot(sheet_name):
+    for path in _snapshot_paths(sheet_name):
+        try: os.remove(path)
+        except OSError: pass
+
+def _refresh_all_snapshots(state):
+    try:
+        titles = refresh_sheet_titles()
+        if titles is not None and OKR_SHEET not in titles:
+            delete_snapshot(OKR_SHEET)  # bảng cũ đã được tách (có thể bởi instance khác)
+        for i, sheet_name in enumerate(snapshot_sheet_names()):
+            if i: time.sleep(REFRESH_PAUSE_SEC)
+            df = fetch_sheet(sheet_name)
+            if df is None: continue
+            save_snapshot(sheet_name, df)
+            state['warm'].add(sheet_name)
+        clear_data_caches()
+    finally:
+        state['refreshing'] = False
+
+def refresh_snapshots_async():
+    """Làm mới toàn bộ snapshot ở luồng nền (mỗi lần chỉ 1 luồng)"""
+    state = get_runtime_state()
+    with state['lock']:
+        if state['refreshing']: return
+        state['refreshing'] = True
+    threading.Thread(target=_refresh_all_snapshots, args=(state,), daemon=True).start()
+
+def is_read_only():
+    return get_runtime_state()['offline']
+
+# Khóa (file) trong lúc tách bảng OKRs: mọi thao tác ghi vào OKRs bị chặn tới khi xong
+OKR_MIGRATION_LOCK = os.path.join(SNAPSHOT_DIR, "okr_migration.lock")
+OKR_MIGRATION_LOCK_TTL = 2 * 3600  # Khóa cũ hơn mức này coi như bị bỏ dở
+
+def okr_migration_running():
+    try:
+        return time.time() - os.path.getmtime(OKR_MIGRATION_LOCK) < OKR_MIGRATION_LOCK_TTL
+    except OSError:
+        return False
+
+def blocked_by_read_only(sheet_name=None):
+    """Chặn thao tác ghi khi đang chạy bằng snapshot, hoặc ghi vào OKRs khi đang tách bảng"""
+    if is_read_only():
+        st.warning("Đang ở chế độ chỉ đọc (mất kết nối Google Sheets).")
+        return True
+    if sheet_name and base_table(sheet_name) == OKR_SHEET and okr_migration_running():
+        st.warning("Đang tách bảng OKRs theo đợt - tạm thời chưa thể thay đổi OKR, vui lòng thử lại sau.")
+        return True
+    return False
+
+@st.cache_data(ttl=10)
+def load_data(sheet_name):
+    """Đọc dữ liệu an toàn với caching (không gồm cột văn bản dài - xem load_text_columns).
+    Lần đầu sau khi khởi động: trả snapshot ngay & làm mới live ở nền.
+    Khi một lần đọc lỗi: dùng snapshot (chuyển sang chỉ đọc hay không do record_read quyết định)."""
+    state = get_runtime_state()
+    text_cols = TEXT_COLUMNS.get(base_table(sheet_name), [])
+    if sheet_name not in state['warm'] and not state['live_only']:
+        snap = load_snapshot(sheet_name, exclude=text_cols)
+        if snap is not None:
+            refresh_snapshots_async()
+            return snap
+    
+    df = fetch_sheet(sheet_name)
+    if df is None:  # lần đọc này lỗi -> dùng snapshot (cờ chỉ đọc do record_read quyết định)
+        snap = load_snapshot(sheet_name, exclude=text_cols)
+        return snap if snap is not None else pd.DataFrame()
+    
+    state['warm'].add(sheet_name)
+    save_snapshot(sheet_name, df)
+    return drop_text_columns(sheet_name, df)
+
+@st.cache_data(ttl=10)
+def load_text_columns(sheet_name, key_col='ID'):
+    """Đọc các cột văn bản dài (theo key_col) khi thật sự cần hiển thị"""
+    cols = [key_col] + TEXT_COLUMNS.get(base_table(sheet_name), [])
+    snap = load_snapshot(sheet_name, columns=cols)
+    if snap is not None: return snap
+    df = fetch_sheet(sheet_name)
+    if df is None: return pd.DataFrame(columns=cols)
+    save_snapshot(sheet_name, df)
+    return df[[c for c in cols if c in df.columns]]
+
+def clear_data_caches():
+    """Xoá cache dữ liệu bảng sau khi ghi (giữ cache ảnh biểu đồ & danh sách worksheet)"""
+    load_data.clear()
+    load_text_columns.clear()
 
 def batch_add_records(sheet_name, rows_data):
     """Thêm nhiều dòng cùng lúc (Fix lỗi 429)"""
+    if blocked_by_read_only(sheet_name): return False
     ws = get_worksheet(sheet_name)
     if ws and rows_data:
         try:
             ws.append_rows(rows_data, value_input_option='USER_ENTERED')
-            st.cache_data.clear()
+            clear_data_caches()
+            if base_table(sheet_name) in PROGRESS_SOURCES:
+                email_idx, dot_idx = (SHEET_HEADERS[base_table(sheet_name)].index(c) for c in PROGRESS_KEYS)
+                touch_progress([(r[email_idx], r[dot_idx]) for r in rows_data])
             return True
         except Exception as e:
             st.error(f"Lỗi Batch Import: {e}")
@@ -127,6 +388,7 @@ def batch_add_records(sheet_name, rows_data):
 
 def update_cell_value(sheet_name, match_col, match_val, update_col, update_val, match_col_2=None, match_val_2=None):
     """Cập nhật 1 ô"""
+    if blocked_by_read_only(sheet_name): return False
     ws = get_worksheet(sheet_name)
     if not ws: return
     try:
@@ -160,33 +422,285 @@ def update_cell_value(sheet_name, match_col, match_val, update_col, update_val,
         
         if row_idx != -1:
             ws.update_cell(row_idx, update_col_idx, update_val)
-            st.cache_data.clear()
+            clear_data_caches()
+            if base_table(sheet_name) in PROGRESS_SOURCES:
+                row = data[row_idx - 2]
+                touch_progress([(row.get('Email_HocSinh', ''), row.get('ID_Dot', 0))])
             return True
     except Exception as e:
         st.error(f"Lỗi cập nhật: {e}")
         return False
 
 def delete_record(sheet_name, match_col, match_val):
+    if blocked_by_read_only(sheet_name): return
     ws = get_worksheet(sheet_name)
     if not ws: return
     try:
         # Tìm và xóa dòng đầu tiên khớp (Simple delete)
         cell = ws.find(str(match_val), in_column=ws.find(match_col).col)
         if cell:
+            touched = []
+            if base_table(sheet_name) in PROGRESS_SOURCES:
+                df = load_data(sheet_name)
+                hit = df[df[match_col].astype(str) == str(match_val)] if match_col in df.columns else df.iloc[0:0]
+                touched = list(zip(hit['Email_HocSinh'], hit['ID_Dot']))[:1]
             ws.delete_rows(cell.row)
-            st.cache_data.clear()
+            clear_data_caches()
+            if touched: touch_progress(touched)
     except: pass
 
+def load_live(sheet_name):
+    """Đọc live (không qua cache/snapshot) cho các thao tác đọc-rồi-ghi. None nếu không đọc được"""
+    df = fetch_sheet(sheet_name)
+    if df is None: st.error(f"Không đọc được dữ liệu mới nhất của '{sheet_name}', vui lòng thử lại.")
+    return df
+
 def get_next_id(sheet_name):
-    df = load_data(sheet_name)
+    """ID mới từ dữ liệu live (snapshot có thể cũ -> trùng ID). None nếu không đọc được"""
+    df = load_live(sheet_name)
+    if df is None: return None
     if df.empty or 'ID' not in df.columns: return 1
     return int(df['ID'].max()) + 1
 
+# --- PHÂN VÙNG OKRs THEO ĐỢT ---
+
+def sheet_titles():
+    """Danh sách worksheet để định tuyến: bản lưu cùng snapshot (không gọi API),
+    chỉ đọc live khi chưa từng lưu. None nếu chưa biết"""
+    titles = load_sheet_titles()
+    return titles if titles is not None else get_sheet_titles()
+
+def resolve_okr_sheet(period_id):
+    """Worksheet chứa OKR của đợt: phân vùng riêng nếu có, ngược lại bảng OKRs cũ (chưa tách)"""
+    part = okr_partition_name(period_id)
+    if os.path.exists(_snapshot_paths(part)[1]): return part
+    titles = sheet_titles()
+    if titles is None:
+        # Mất kết nối & chưa biết danh sách worksheet: còn snapshot bảng cũ -> chưa tách
+        return OKR_SHEET if os.path.exists(_snapshot_paths(OKR_SHEET)[1]) else part
+    if part in titles or OKR_SHEET not in titles: return part
+    return OKR_SHEET
+
+def list_okr_sheets():
+    """Mọi worksheet đang chứa OKR (bảng cũ + các phân vùng)"""
+    titles = get_sheet_titles() or []
+    return [t for t in titles if t == OKR_SHEET or is_okr_partition(t)]
+
+def load_okrs(period_id):
+    """OKR của một đợt (chỉ đọc phân vùng của đợt đó)"""
+    sheet = resolve_okr_sheet(period_id)
+    if sheet != OKR_SHEET and not os.path.exists(_snapshot_paths(sheet)[1]) and sheet not in (sheet_titles() or []):
+        # Đợt chưa có phân vùng -> không có OKR (tránh tự tạo worksheet khi chỉ đọc)
+        return drop_text_columns(sheet, pd.DataFrame(columns=SHEET_HEADERS[OKR_SHEET]))
+    df = load_data(sheet)
+    if sheet == OKR_SHEET and not df.empty and 'ID_Dot' in df.columns:
+        df = df[df['ID_Dot'] == period_id]
+    return df
+
+def create_okr_partition(period_id):
+    """Tạo sẵn worksheet phân vùng (kèm header) khi thêm đợt mới"""
+    if blocked_by_read_only(okr_partition_name(period_id)): return False
+    return get_worksheet(okr_partition_name(period_id)) is not None
+
+def _raw_values(ws):
+    """Giá trị gốc (số là số, không định dạng) - ghi lại bằng RAW sẽ giống hệt bản cũ"""
+    return ws.get_all_values(value_render_option='UNFORMATTED_VALUE')
+
+def _okr_row_key(row):
+    """Khóa nhận diện một dòng OKR khi tách bảng (ID có thể trùng giữa bảng cũ & phân vùng tạo sau)"""
+    return tuple(str(v).strip() for v in row[:5])  # ID, Email_HocSinh, ID_Dot, MucTieu, KetQuaThenChot
+
+def _group_legacy_okrs(values):
+    """Chia các dòng của bảng OKRs cũ theo ID_Dot, sắp cột theo header chuẩn"""
+    header, rows = values[0], values[1:]
+    target_header = SHEET_HEADERS[OKR_SHEET]
+    col_idx = {c: header.index(c) for c in target_header if c in header}
+    groups = {}
+    for r in rows:
+        try: pid = int(float(r[col_idx['ID_Dot']]))
+        except (KeyError, IndexError, ValueError): pid = 0
+        groups.setdefault(pid, []).append([r[col_idx[c]] if c in col_idx and col_idx[c] < len(r) else "" for c in target_header])
+    return groups
+
+def migrate_okrs_to_partitions(on_progress=None):
+    """Tách bảng OKRs cũ thành các phân vùng theo ID_Dot.
+    - Trong suốt quá trình, mọi thao tác ghi OKR bị chặn (khóa OKR_MIGRATION_LOCK).
+    - Mỗi đợt được chép vào worksheet tạm "OKRs_<id>_dangtach", chỉ đổi tên thành "OKRs_<id>"
+      (tức là bắt đầu được dùng) khi đã chép đủ -> không bao giờ đọc/cấp ID trên phân vùng dở dang.
+    - Trước khi đổi tên bảng cũ thành bản sao lưu: đọc lại & đối chiếu từng dòng với phân vùng.
+    Chạy lại an toàn (bỏ qua dòng đã chép). Trả về dict {ID_Dot: số dòng đã chuyển}."""
+    if blocked_by_read_only(OKR_SHEET): return {}
+    if OKR_SHEET not in (refresh_sheet_titles() or []): return {}
+    ws = get_worksheet(OKR_SHEET)
+    if not ws: return {}
+    
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with open(OKR_MIGRATION_LOCK, "w") as f: f.write(str(time.time()))
+    try:
+        values = _raw_values(ws)
+        if not values: return {}
+        groups = _group_legacy_okrs(values)
+        
+        moved = {}
+        for n, (pid, part_rows) in enumerate(sorted(groups.items()), 1):
+            final_name = okr_partition_name(pid)
+            # Phân vùng đã hoàn tất (hoặc tạo cho đợt mới) -> chép thẳng; ngược lại chép vào bảng tạm
+            target = final_name if final_name in (get_sheet_titles() or []) else f"{final_name}_dangtach"
+            part_ws = get_worksheet(target)
+            if not part_ws: raise RuntimeError(f"Không tạo được phân vùng đợt {pid}")
+            existing = _raw_values(part_ws)
+            if not existing: part_ws.append_row(SHEET_HEADERS[OKR_SHEET])  # bảng tạm chưa có header
+            done = {_okr_row_key(r) for r in existing[1:]}
+            todo = [r for r in part_rows if _okr_row_key(r) not in done]
+            if todo and append_rows_chunked(target, todo, migrating=True) < count_chunks(todo):
+                raise RuntimeError(f"Dừng ở phân vùng đợt {pid} - chạy lại để tiếp tục")
+            if target != final_name:
+                part_ws.update_title(final_name)
+                refresh_sheet_titles()
+            moved[pid] = len(todo)
+            if on_progress: on_progress(n, len(groups))
+        
+        # Đối chiếu lần cuối: bảng cũ không đổi & mọi dòng đã có trong phân vùng
+        if _raw_values(ws) != values:
+            raise RuntimeError("Bảng OKRs cũ đã thay đổi trong lúc tách - chạy lại để chép phần còn thiếu")
+        for pid, part_rows in groups.items():
+            have = {_okr_row_key(r) for r in _raw_values(get_worksheet(okr_partition_name(pid)))[1:]}
+            missing = [r for r in part_rows if _okr_row_key(r) not in have]
+            if missing:
+                raise RuntimeError(f"Phân vùng đợt {pid} còn thiếu {len(missing)} dòng - chạy lại để tiếp tục")
+        
+        ws.update_title(f"{OKR_SHEET}_backup_{time.strftime('%Y%m%d_%H%M%S')}")
+        delete_snapshot(OKR_SHEET)
+        return moved
+    finally:
+        try: os.remove(OKR_MIGRATION_LOCK)
+        except OSError: pass
+        clear_data_caches()
+        refresh_sheet_titles()
+
+# --- IMPORT EXCEL THEO LÔ (STREAMING) ---
+IMPORT_CHUNK_SIZE = 200     # Số dòng mỗi lần append_rows
+IMPORT_PAUSE_SEC = 1.1      # Giãn cách giữa các lô (quota ~60 request/phút)
+IMPORT_MAX_RETRIES = 5
+EMAIL_PATTERN = r'^[^@\s]+@[^@\s]+\.[^@\s]+$'
+# Checkpoint import lưu ra đĩa (không phụ thuộc phiên trình duyệt) để chạy tiếp sau khi mất kết nối / tải lại trang
+IMPORT_CKPT_DIR = os.path.join(APP_DIR, os.environ.get("OKR_IMPORT_DIR", ".okr_import"))
+
+def _import_ckpt_path(key):
+    return os.path.join(IMPORT_CKPT_DIR, f"{key}.json")
+
+def load_import_checkpoint(key):
+    try:
+        with open(_import_ckpt_path(key), encoding="utf-8") as f:
+            ck = json.load(f)
+        ck['rejected'] = pd.DataFrame(ck['rejected'])
+        return ck
+    except (OSError, ValueError, KeyError):
+        return None
+
+def delete_import_checkpoint(key):
+    try: os.remove(_import_ckpt_path(key))
+    except OSError: pass
+
+def save_import_checkpoint(key, ck):
+    os.makedirs(IMPORT_CKPT_DIR, exist_ok=True)
+    tmp = _import_ckpt_path(key) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({**ck, 'rejected': ck['rejected'].to_dict('records')}, f, ensure_ascii=False)
+    os.replace(tmp, _import_ckpt_path(key))
+
+def read_roster_xlsx(file_obj, chunk_rows=5000):
+    """Đọc file Excel ở chế độ read-only (stream từng dòng), chỉ giữ các cột cần dùng"""
+    from openpyxl import load_workbook
+    wb = load_workbook(file_obj, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header: return pd.DataFrame()
+        header = [str(h).strip() if h is not None else "" for h in header]
+        wanted = [c for c in ['Email', 'HoTen', 'EmailPH', 'TenLop'] if c in header]
+        idx = [header.index(c) for c in wanted]
+        
+        frames, buf = [], []
+        for r in rows:
+            buf.append([r[i] if i < len(r) else None for i in idx])
+            if len(buf) >= chunk_rows:
+                frames.append(pd.DataFrame(buf, columns=wanted))
+                buf = []
+        if buf: frames.append(pd.DataFrame(buf, columns=wanted))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=wanted)
+    finally:
+        wb.close()
+
+def _clean_text_col(df, col, default=""):
+    if col not in df.columns: return pd.Series(default, index=df.index)
+    return df[col].fillna("").astype(str).str.strip()
+
+def prepare_roster(df_up, existing_emails, default_class, valid_classes=None):
+    """Chuẩn hoá & kiểm tra danh sách HS (vector hoá).
+    Trả về (dòng Users, dòng Relationships, DataFrame các dòng bị loại kèm lý do)"""
+    if 'Email' not in df_up.columns: raise ValueError("File thiếu cột Email")
+    df = pd.DataFrame({
+        'Email': _clean_text_col(df_up, 'Email'),
+        'HoTen': _clean_text_col(df_up, 'HoTen'),
+        'EmailPH': _clean_text_col(df_up, 'EmailPH'),
+        'TenLop': _clean_text_col(df_up, 'TenLop').replace("", default_class),
+    })
+    df = df[df['Email'] != ""]
+    
+    reason = pd.Series("", index=df.index)
+    reason[~df['Email'].str.match(EMAIL_PATTERN)] = "Email không hợp lệ"
+    if valid_classes is not None:
+        reason[(reason == "") & ~df['TenLop'].isin(valid_classes)] = "Lớp không hợp lệ"
+    reason[(reason == "") & df['Email'].isin(existing_emails)] = "Email đã tồn tại"
+    # Trùng trong file: chỉ xét trên các dòng còn hợp lệ, giữ dòng đầu tiên
+    ok_mask = reason == ""
+    dup = df['Email'].where(ok_mask).duplicated(keep='first') & ok_mask
+    reason[dup] = "Trùng trong file"
+    
+    ok = df[reason == ""]
+    users_rows = ok.assign(Password="123", VaiTro="HocSinh")[['Email', 'Password', 'HoTen', 'VaiTro', 'TenLop']].values.tolist()
+    rels_rows = ok[ok['EmailPH'] != ""][['Email', 'EmailPH']].values.tolist()
+    rejected = df[reason != ""].assign(LyDo=reason[reason != ""])
+    return users_rows, rels_rows, rejected
+
+def count_chunks(rows_data, chunk_size=IMPORT_CHUNK_SIZE):
+    return -(-len(rows_data) // chunk_size)
+
+def append_rows_chunked(sheet_name, rows_data, chunk_size=IMPORT_CHUNK_SIZE, start_chunk=0, on_progress=None, migrating=False):
+    """Ghi theo từng lô, giãn cách & thử lại khi vượt quota (429).
+    Trả về số lô đã ghi xong (checkpoint để chạy tiếp).
+    migrating=True: ghi của chính bước tách bảng OKRs - ghi RAW để "8/10" không bị hiểu thành ngày."""
+    if blocked_by_read_only(None if migrating else sheet_name): return start_chunk
+    ws = get_worksheet(sheet_name)
+    if not ws: return start_chunk
+    total = count_chunks(rows_data, chunk_size)
+    done = start_chunk
+    try:
+        while done < total:
+            chunk = rows_data[done * chunk_size:(done + 1) * chunk_size]
+            for attempt in range(IMPORT_MAX_RETRIES):
+                try:
+                    ws.append_rows(chunk, value_input_option='RAW' if migrating else 'USER_ENTERED')
+                    break
+                except Exception as e:
+                    if '429' not in str(e) or attempt == IMPORT_MAX_RETRIES - 1: raise
+                    time.sleep(IMPORT_PAUSE_SEC * 2 ** (attempt + 1))
+            done += 1
+            if on_progress: on_progress(done, total)
+            if done < total: time.sleep(IMPORT_PAUSE_SEC)
+    except Exception as e:
+        st.error(f"Lỗi Batch Import ({sheet_name}, lô {done + 1}/{total}): {e}")
+    finally:
+        if done > start_chunk: clear_data_caches()
+    return done
+
 # --- CÁC HÀM XỬ LÝ LOGIC PHỨC TẠP ---
 
 def upsert_final_review(email, id_dot, col_name, value):
     """Insert hoặc Update nhận xét"""
-    df = load_data("FinalReviews")
+    df = load_live("FinalReviews")
+    if df is None: return False
     exists = False
     if not df.empty:
         mask = (df['Email_HocSinh'] == email) & (df['ID_Dot'] == id_dot)
@@ -203,6 +717,7 @@ def upsert_final_review(email, id_dot, col_name, value):
 
 def update_student_email_cascade(old_email, new_email):
     """Đổi Email học sinh và cập nhật tất cả bảng liên quan"""
+    if blocked_by_read_only(OKR_SHEET): return False
     try:
         # 1. Update Users
         update_cell_value("Users", "Email", old_email, "Email", new_email)
@@ -210,9 +725,9 @@ def update_student_email_cascade(old_email, new_email):
         # 2. Update Related Tables
         tables_map = {
             "Relationships": ["Email_HocSinh", "Email_PhuHuynh"],
-            "OKRs": ["Email_HocSinh"],
             "FinalReviews": ["Email_HocSinh"]
         }
+        for okr_sheet in list_okr_sheets(): tables_map[okr_sheet] = ["Email_HocSinh"]
         
         for table, cols in tables_map.items():
             ws = get_worksheet(table)
@@ -229,7 +744,8 @@ def update_student_email_cascade(old_email, new_email):
             except Exception as ex:
                 print(f"Skip {table}: {ex}")
         
-        st.cache_data.clear()
+        clear_data_caches()
+        rewrite_progress(lambda df: df.assign(Email_HocSinh=df['Email_HocSinh'].replace(old_email, new_email)))
         return True
     except Exception as e:
         st.error(f"Lỗi đồng bộ Email: {e}")
@@ -237,6 +753,7 @@ def update_student_email_cascade(old_email, new_email):
 
 def delete_student_fully(email):
     """Xóa hoàn toàn học sinh và dữ liệu liên quan"""
+    if blocked_by_read_only(OKR_SHEET): return False
     try:
         # 1. Delete from Users
         delete_record("Users", "Email", email)
@@ -245,9 +762,10 @@ def delete_student_fully(email):
         delete_record("Relationships", "Email_HocSinh", email)
         delete_record("FinalReviews", "Email_HocSinh", email)
         
-        # OKRs có thể có nhiều dòng, cần xóa hết
-        ws_okr = get_worksheet("OKRs")
-        if ws_okr:
+        # OKRs có thể có nhiều dòng (ở bảng cũ & mọi phân vùng), cần xóa hết
+        for okr_sheet in list_okr_sheets():
+            ws_okr = get_worksheet(okr_sheet)
+            if not ws_okr: continue
             try:
                 # Tìm tất cả cells chứa email
                 cells = ws_okr.findall(email, in_column=ws_okr.find("Email_HocSinh").col)
@@ -257,7 +775,8 @@ def delete_student_fully(email):
                     ws_okr.delete_rows(r)
             except: pass
             
-        st.cache_data.clear()
+        clear_data_caches()
+        rewrite_progress(lambda df: df[df['Email_HocSinh'] != email])
         return True
     except Exception as e:
         st.error(f"Lỗi xóa dữ liệu: {e}")
@@ -278,7 +797,171 @@ def get_rank(percent):
     elif percent >= 50: return "Đạt", "orange"
     return "Chưa đạt", "red"
 
+def compute_student_results(students, okrs, reviews, period_id):
+    """Kết quả từng HS trong đợt (vector hoá): số OKR, % trung bình, xếp loại, trạng thái duyệt/nhận xét"""
+    res = pd.DataFrame({
+        'Email': students['Email'].astype(str) if not students.empty else pd.Series(dtype=str),
+        'HoTen': students['HoTen'].astype(str) if not students.empty else pd.Series(dtype=str),
+        'TenLop': students['TenLop'].astype(str) if not students.empty else pd.Series(dtype=str),
+    }).reset_index(drop=True)
+    
+    agg = pd.DataFrame(columns=['SoOKR', 'TrungBinh', 'ChoDuyet'])
+    if not okrs.empty:
+        o = okrs[okrs['ID_Dot'] == period_id]
+        target, actual = o['TargetValue'].astype(float), o['ActualValue'].astype(float)
+        # Giống calculate_percent: làm tròn từng KR rồi mới lấy trung bình
+        pct = (actual / target.where(target != 0) * 100).round(1).fillna(0)
+        agg = pd.DataFrame({
+            'Email': o['Email_HocSinh'].astype(str), 'Pct': pct,
+            'Cho': (o['TrangThai'].astype(str) == 'ChoDuyet').astype(int),
+        }).groupby('Email').agg(SoOKR=('Pct', 'size'), TrungBinh=('Pct', 'mean'), ChoDuyet=('Cho', 'sum'))
+        agg['TrungBinh'] = agg['TrungBinh'].round(1)
+    res = res.merge(agg, left_on='Email', right_index=True, how='left')
+    res[['SoOKR', 'ChoDuyet']] = res[['SoOKR', 'ChoDuyet']].fillna(0).astype(int)
+    res['TrungBinh'] = res['TrungBinh'].astype(float).fillna(0)
+    res['XepLoai'] = [get_rank(v)[0] if n else "" for v, n in zip(res['TrungBinh'], res['SoOKR'])]
+    
+    res['DaNhanXet_GV'] = False
+    res['DaGui_PH'] = False
+    if not reviews.empty:
+        r = reviews[reviews['ID_Dot'] == period_id]
+        r = r.assign(Email=r['Email_HocSinh'].astype(str)).drop_duplicates('Email').set_index('Email')
+        res['DaNhanXet_GV'] = res['Email'].map(r['NhanXet_GV'].astype(str) != "").fillna(False).astype(bool)
+        if 'DaGui_PH' in r.columns:
+            res['DaGui_PH'] = res['Email'].map(r['DaGui_PH'] == 1).fillna(False).astype(bool)
+    return res
+
+def compute_class_stats(period_id, classes, users, okrs, reviews):
+    """Bảng thống kê theo lớp cho một đợt"""
+    stats = []
+    for _, cl in classes.iterrows():
+        ten_lop = cl.get('TenLop', '')
+        siso = int(cl.get('SiSo', 0))
+        
+        hs_list = []
+        if not users.empty and 'TenLop' in users.columns:
+            hs_list = users[users['TenLop'] == ten_lop]['Email'].tolist()
+        
+        okr_count = 0
+        approved_count = 0
+        if hs_list:
+            if not okrs.empty:
+                okr_count = okrs[(okrs['ID_Dot'] == period_id) & (okrs['Email_HocSinh'].isin(hs_list))].shape[0]
+            if not reviews.empty:
+                approved_count = reviews[(reviews['ID_Dot'] == period_id) & (reviews['Email_HocSinh'].isin(hs_list)) & (reviews['NhanXet_GV'] != "")].shape[0]
+        
+        stats.append({
+            "Lớp": ten_lop, "GVCN": cl.get('EmailGVCN', ''), "Sĩ số": siso,
+            "Tổng OKR": okr_count, "HS Đã Duyệt": f"{approved_count}/{len(hs_list)}"
+        })
+    return pd.DataFrame(stats)
+
+# --- TỔNG HỢP TIẾN BỘ QUA CÁC ĐỢT ---
+# Bảng (HS, lớp, đợt) -> % trung bình, xếp loại, tỉ lệ duyệt. Cập nhật từng phần mỗi khi
+# batch_add_records / update_cell_value / delete_record chạm vào OKRs hoặc FinalReviews.
+# Các trang "Xu hướng" chỉ đọc bảng này.
+AGG_DIR = os.path.join(APP_DIR, os.environ.get("OKR_AGG_DIR", ".okr_agg"))
+PROGRESS_SOURCES = (OKR_SHEET, "FinalReviews")
+PROGRESS_KEYS = ['Email_HocSinh', 'ID_Dot']
+PROGRESS_COLUMNS = ['Email_HocSinh', 'TenLop', 'ID_Dot', 'TenDot', 'SoOKR', 'TrungBinh', 'XepLoai', 'TiLeDuyet', 'DaNhanXet_GV', 'CapNhat']
+
+def _progress_path():
+    return os.path.join(AGG_DIR, "progress.parquet")
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _read_progress(mtime):
+    return pd.read_parquet(_progress_path())
+
+def load_progress():
+    """Bảng tổng hợp tiến bộ (đọc từ đĩa, cache theo thời điểm ghi)"""
+    try:
+        return _read_progress(os.path.getmtime(_progress_path()))
+    except (OSError, ValueError):
+        return pd.DataFrame(columns=PROGRESS_COLUMNS)
+
+def _write_progress(df):
+    os.makedirs(AGG_DIR, exist_ok=True)
+    tmp = _progress_path() + ".tmp"
+    df[PROGRESS_COLUMNS].sort_values(PROGRESS_KEYS).reset_index(drop=True).to_parquet(tmp, index=False)
+    os.replace(tmp, _progress_path())
+
+def rewrite_progress(fn):
+    """Áp dụng fn(DataFrame) -> DataFrame lên bảng tổng hợp (dùng cho đổi/xóa email)"""
+    try:
+        with get_runtime_state()['progress_lock']:
+            cur = load_progress()
+            if not cur.empty: _write_progress(fn(cur))
+    except Exception as e:
+        print(f"Skip progress rewrite: {e}")
+
+def compute_progress_rows(period_id, emails=None):
+    """Tính các dòng tổng hợp của một đợt (cho toàn bộ HS hoặc chỉ các email được chỉ định)"""
+    users = load_data("Users")
+    if users.empty: return pd.DataFrame(columns=PROGRESS_COLUMNS)
+    students = users[users['TenLop'].astype(str) != ""]
+    if emails is not None: students = students[students['Email'].astype(str).isin(emails)]
+    res = compute_student_results(students, load_okrs(period_id), load_data("FinalReviews"), period_id)
+    
+    periods = load_data("Periods")
+    p_row = periods[periods['ID'] == period_id] if not periods.empty else periods
+    ten_dot = str(p_row.iloc[0]['TenDot']) if not p_row.empty else f"Đợt {period_id}"
+    return pd.DataFrame({
+        'Email_HocSinh': res['Email'], 'TenLop': res['TenLop'],
+        'ID_Dot': int(period_id), 'TenDot': ten_dot,
+        'SoOKR': res['SoOKR'], 'TrungBinh': res['TrungBinh'], 'XepLoai': res['XepLoai'],
+        'TiLeDuyet': ((res['SoOKR'] - res['ChoDuyet']) / res['SoOKR'].where(res['SoOKR'] > 0) * 100).round(1).fillna(0),
+        'DaNhanXet_GV': res['DaNhanXet_GV'], 'CapNhat': time.time(),
+    }, columns=PROGRESS_COLUMNS)
+
+def touch_progress(keys):
+    """Tính lại các cặp (email HS, đợt) vừa thay đổi và thay thế chúng trong bảng tổng hợp"""
+    try:
+        by_period = {}
+        for email, period_id in keys:
+            if not email: continue
+            by_period.setdefault(int(float(period_id)), set()).add(str(email))
+        if not by_period: return
+        if not os.path.exists(_progress_path()):
+            # Chưa có bảng (mới triển khai) -> dựng toàn bộ thay vì chỉ ghi các cặp vừa đổi
+            rebuild_progress()
+            return
+        fresh = [compute_progress_rows(pid, emails) for pid, emails in by_period.items()]
+        
+        with get_runtime_state()['progress_lock']:
+            cur = load_progress()
+            stale = pd.Series(False, index=cur.index)
+            for pid, emails in by_period.items():
+                stale |= (cur['ID_Dot'] == pid) & cur['Email_HocSinh'].isin(emails)
+            _write_progress(pd.concat([cur[~stale]] + fresh, ignore_index=True))
+    except Exception as e:
+        print(f"Skip progress update: {e}")
+
+def rebuild_progress():
+    """Tính lại toàn bộ bảng tổng hợp từ đầu (lần đầu dùng hoặc khi nghi ngờ lệch)"""
+    periods = load_data("Periods")
+    frames = [compute_progress_rows(int(pid)) for pid in periods['ID']] if not periods.empty else []
+    with get_runtime_state()['progress_lock']:
+        _write_progress(pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=PROGRESS_COLUMNS))
+    return sum(len(f) for f in frames)
+
+def summarize_progress(prog, by):
+    """Gộp theo by (vd. ['ID_Dot', 'TenDot']): % TB, tỉ lệ duyệt & phân bố xếp loại (chỉ tính HS đã có OKR)"""
+    active = prog[prog['SoOKR'] > 0]
+    if active.empty: return pd.DataFrame()
+    out = active.groupby(by, observed=True).agg(
+        SoHS=('Email_HocSinh', 'size'), TrungBinh=('TrungBinh', 'mean'), TiLeDuyet=('TiLeDuyet', 'mean'))
+    bands = pd.crosstab([active[c] for c in by], active['XepLoai'])
+    out = out.join(bands).fillna(0)
+    return out.round(1).reset_index()
+
+def period_labels(prog):
+    """Nhãn hiển thị cho từng ID_Dot: TenDot, kèm "(ID)" nếu nhiều đợt trùng tên"""
+    pairs = prog[['ID_Dot', 'TenDot']].drop_duplicates('ID_Dot')
+    dup = pairs['TenDot'].astype(str).duplicated(keep=False)
+    return {pid: f"{name} ({pid})" if d else str(name) for pid, name, d in zip(pairs['ID_Dot'], pairs['TenDot'], dup)}
+
 def add_student_report_to_doc(doc, student_name, class_name, period_name, okr_df, review_gv, review_ph):
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
     doc.add_heading('PHIẾU KẾT QUẢ OKR', 0).alignment = WD_ALIGN_PARAGRAPH.CENTER
     doc.add_paragraph(f'Họ tên: {student_name} | Lớp: {class_name}')
     doc.add_paragraph(f'Đợt: {period_name} | Ngày: {time.strftime("%d/%m/%Y")}')
@@ -313,6 +996,7 @@ def add_student_report_to_doc(doc, student_name, class_name, period_name, okr_df
     doc.add_paragraph(f"Phụ huynh: {review_ph if review_ph else '---'}")
 
 def create_single_docx(student_name, class_name, period_name, okr_df, review_gv, review_ph):
+    from docx import Document
     doc = Document()
     add_student_report_to_doc(doc, student_name, class_name, period_name, okr_df, review_gv, review_ph)
     bio = io.BytesIO()
@@ -320,6 +1004,7 @@ def create_single_docx(student_name, class_name, period_name, okr_df, review_gv,
     return bio.getvalue()
 
 def create_class_report_docx(class_name, list_students, all_okrs, all_reviews, period_name, period_id):
+    from docx import Document
     doc = Document()
     count = 0
     for idx, hs in list_students.iterrows():
@@ -342,6 +1027,195 @@ def create_class_report_docx(class_name, list_students, all_okrs, all_reviews, p
     doc.save(bio)
     return bio.getvalue()
 
+# --- BIỂU ĐỒ ---
+# "matplotlib": ảnh PNG cache theo số liệu; "native": biểu đồ Vega-Lite của Streamlit
+CHART_BACKEND = os.environ.get("OKR_CHART_BACKEND", "matplotlib")
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def render_rank_pie_png(class_name, period_id, rank_counts):
+    """Vẽ biểu đồ tròn xếp loại thành PNG. Cache theo (lớp, đợt, số lượng từng loại)
+    nên chỉ vẽ lại khi số liệu thay đổi."""
+    from matplotlib.figure import Figure
+    # Dùng Figure trực tiếp (không qua pyplot) -> không lưu figure trong bộ quản lý toàn cục
+    fig = Figure(figsize=(2, 2))
+    ax = fig.subplots()
+    labels, values = zip(*rank_counts)
+    ax.pie(values, labels=labels, autopct='%1.0f%%', textprops={'fontsize': 6})
+    bio = io.BytesIO()
+    fig.savefig(bio, format='png', dpi=150, bbox_inches='tight')
+    fig.clear()
+    return bio.getvalue()
+
+def show_rank_chart(class_name, period_id, ranks):
+    rank_counts = tuple((k, int(v)) for k, v in ranks.items())
+    if CHART_BACKEND == "native":
+        df = pd.DataFrame(rank_counts, columns=["Xếp loại", "Số HS"])
+        st.vega_lite_chart(df[df["Số HS"] > 0], {
+            "mark": {"type": "arc", "tooltip": True},
+            "encoding": {
+                "theta": {"field": "Số HS", "type": "quantitative"},
+                "color": {"field": "Xếp loại", "type": "nominal", "sort": [k for k, _ in rank_counts]},
+            },
+        }, width="stretch")
+    else:
+        st.image(render_rank_pie_png(class_name, period_id, rank_counts))
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+# --- KẾT QUẢ ĐÓNG BĂNG (ĐỢT ĐÃ KHÓA) ---
+# Khi khóa đợt: chốt kết quả HS, thống kê lớp & báo cáo Word vào thư mục chỉ đọc;
+# xem đợt đã khóa thì đọc từ đây, không gọi Google Sheets. Mở lại đợt -> xóa bản chốt.
+FROZEN_DIR = os.path.join(APP_DIR, os.environ.get("OKR_FROZEN_DIR", ".okr_frozen"))
+
+def _frozen_dir(period_id):
+    return os.path.join(FROZEN_DIR, f"period_{int(period_id)}")
+
+def is_frozen(period_id):
+    return os.path.exists(os.path.join(_frozen_dir(period_id), "manifest.json"))
+
+def fetch_period_okrs(period_id):
+    """OKR của một đợt, đọc live (không qua cache/snapshot). None nếu không đọc được"""
+    titles = refresh_sheet_titles()
+    if titles is None: return None
+    part = okr_partition_name(period_id)
+    if part in titles: return fetch_sheet(part)
+    if OKR_SHEET not in titles: return pd.DataFrame(columns=SHEET_HEADERS[OKR_SHEET])
+    df = fetch_sheet(OKR_SHEET)
+    if df is not None and not df.empty and 'ID_Dot' in df.columns:
+        df = df[df['ID_Dot'] == period_id]
+    return df
+
+def freeze_period(period_id, period_name):
+    """Chốt kết quả của đợt đã khóa. Ghi vào thư mục tạm rồi đổi tên (không bao giờ ghi đè bản chốt cũ).
+    Chỉ chốt từ dữ liệu live - từ chối khi đang chỉ đọc hoặc không đọc được bảng nào."""
+    if is_frozen(period_id): return True
+    if is_read_only(): return False
+    periods = fetch_sheet("Periods")
+    if periods is None or periods.empty: return False
+    row = periods[periods['ID'] == period_id]
+    if row.empty or str(row.iloc[0]['TrangThai']) != 'Khoa': return False  # chỉ chốt đợt đã khóa
+    classes = fetch_sheet("Classes")
+    users = fetch_sheet("Users")
+    reviews = fetch_sheet("FinalReviews")
+    okrs = fetch_period_okrs(period_id)
+    if any(df is None for df in (classes, users, reviews, okrs)): return False
+    if classes.empty or users.empty: return False
+    
+    students = users[users['TenLop'].astype(str) != ""]
+    results = compute_student_results(students, okrs, reviews, period_id)
+    class_stats = compute_class_stats(period_id, classes, users, okrs, reviews)
+    
+    final_dir = _frozen_dir(period_id)
+    tmp_dir = f"{final_dir}.tmp{os.getpid()}"
+    try:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(os.path.join(tmp_dir, "reports"))
+        results.to_parquet(os.path.join(tmp_dir, "students.parquet"), index=False)
+        class_stats.to_parquet(os.path.join(tmp_dir, "classes.parquet"), index=False)
+        
+        reports = {}
+        for i, class_name in enumerate(classes['TenLop'].astype(str)):
+            class_students = users[users['TenLop'] == class_name]
+            file_name = f"class_{i}.docx"
+            with open(os.path.join(tmp_dir, "reports", file_name), "wb") as f:
+                f.write(create_class_report_docx(class_name, class_students, okrs, reviews, period_name, period_id))
+            reports[class_name] = file_name
+        
+        manifest = {"period_id": int(period_id), "period_name": str(period_name),
+                    "frozen_at": time.time(), "students": len(results), "reports": reports}
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        for root, _, files in os.walk(tmp_dir):
+            for fn in files: os.chmod(os.path.join(root, fn), 0o444)
+        
+        shutil.rmtree(final_dir, ignore_errors=True)  # bản dở dang (không có manifest)
+        os.replace(tmp_dir, final_dir)
+        return True
+    except Exception as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        st.error(f"Lỗi chốt kết quả đợt: {e}")
+        return False
+
+def unfreeze_period(period_id):
+    shutil.rmtree(_frozen_dir(period_id), ignore_errors=True)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _read_frozen(period_id, frozen_at):
+    base = _frozen_dir(period_id)
+    return {
+        "students": pd.read_parquet(os.path.join(base, "students.parquet")),
+        "classes": pd.read_parquet(os.path.join(base, "classes.parquet")),
+    }
+
+def load_frozen(period_id):
+    """Kết quả đã chốt của đợt (dict: meta, students, classes) hoặc None nếu chưa chốt"""
+    try:
+        with open(os.path.join(_frozen_dir(period_id), "manifest.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        return {"meta": meta, **_read_frozen(period_id, meta["frozen_at"])}
+    except (OSError, ValueError, KeyError):
+        return None
+
+def load_frozen_report(period_id, class_name):
+    frozen = load_frozen(period_id)
+    if not frozen or class_name not in frozen["meta"]["reports"]: return None
+    with open(os.path.join(_frozen_dir(period_id), "reports", frozen["meta"]["reports"][class_name]), "rb") as f:
+        return f.read()
+
+def load_frozen_if_locked(period_id):
+    """Bản chốt chỉ dùng khi bảng Periods ghi đợt đang 'Khoa'. Đợt đã mở lại (trực tiếp trên sheet
+    hoặc từ instance khác) -> bỏ bản chốt, nhưng chỉ khi trạng thái đọc được là dữ liệu live."""
+    frozen = load_frozen(period_id)
+    if frozen is None: return None
+    periods = load_data("Periods")
+    row = periods[periods['ID'] == period_id] if not periods.empty else periods
+    if not row.empty and str(row.iloc[0]['TrangThai']) == 'Khoa': return frozen
+    if not periods.empty and "Periods" in get_runtime_state()['warm'] and not is_read_only():
+        unfreeze_period(period_id)
+    return None
+
+# --- BÁO CÁO DỰNG SẴN (do jobs.py chạy ngoài giờ) ---
+JOBS_DIR = os.path.join(APP_DIR, os.environ.get("OKR_JOBS_DIR", ".okr_jobs"))
+
+def prebuilt_reports_dir(period_id):
+    return os.path.join(JOBS_DIR, "reports", f"period_{int(period_id)}")
+
+def load_prebuilt_report(period_id, class_name):
+    """Báo cáo lớp do batch job dựng sẵn: (bytes, thời điểm dựng) hoặc None"""
+    base = prebuilt_reports_dir(period_id)
+    try:
+        with open(os.path.join(base, "manifest.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(os.path.join(base, meta["reports"][class_name]), "rb") as f:
+            return f.read(), meta["generated_at"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def show_frozen_results(period_id, frozen):
+    meta = frozen["meta"]
+    st.caption(f"❄️ Đợt đã khóa - kết quả chốt lúc {time.strftime('%d/%m/%Y %H:%M', time.localtime(meta['frozen_at']))}")
+    df_stats = frozen["classes"]
+    st.dataframe(df_stats)
+    if not df_stats.empty: st.bar_chart(df_stats.set_index("Lớp")[["Tổng OKR"]])
+    with st.expander("Kết quả từng học sinh"):
+        st.dataframe(frozen["students"])
+    if meta["reports"]:
+        c1, c2 = st.columns([3, 2])
+        class_name = c1.selectbox("Báo cáo lớp", list(meta["reports"].keys()), key=f"frozen_cls_{period_id}")
+        c2.download_button("📥 Tải báo cáo đã chốt", data=load_frozen_report(period_id, class_name) or b"",
+                           file_name=f"BaoCaoLop_{class_name}_{meta['period_name']}.docx", mime=DOCX_MIME)
+
+def report_download_button(label, key, build, file_name):
+    """Chỉ dựng báo cáo (và nạp python-docx) một lần khi người dùng bấm chuẩn bị.
+    File đã dựng giữ trong session tới khi tải về (sau đó xóa để lần sau dựng lại dữ liệu mới)."""
+    slot = f"report_data_{key}"
+    if slot in st.session_state:
+        st.download_button(label, data=st.session_state[slot], file_name=file_name, mime=DOCX_MIME, key=f"dl_{key}",
+                           on_click=lambda: st.session_state.pop(slot, None))
+    elif st.button(f"📄 Chuẩn bị: {label}", key=f"prep_{key}"):
+        st.session_state[slot] = build()
+        st.rerun()
+
 def change_password_ui(email):
     with st.expander("🔐 Đổi mật khẩu"):
         with st.form("change_pass"):
@@ -353,6 +1227,68 @@ def change_password_ui(email):
                     st.success("Thành công!")
                 else: st.error("Mật khẩu không khớp.")
 
+def roster_import_ui(class_name=None):
+    """Import danh sách HS từ Excel theo lô, có checkpoint trên đĩa.
+    class_name: lớp của GVCN (chỉ nhận lớp này); None = Admin, nhận mọi lớp trong bảng Classes."""
+    scope = str(class_name) if class_name is not None else "__admin__"
+    upl = st.file_uploader("Chọn file .xlsx", type=['xlsx'], key=f"roster_{scope}")
+    if upl:
+        try:
+            raw = upl.getvalue()
+            key = hashlib.md5(raw + scope.encode()).hexdigest()
+            ck = load_import_checkpoint(key)
+            if ck is None:
+                df_up = read_roster_xlsx(io.BytesIO(raw))
+                live_users = load_live("Users")
+                if live_users is None: st.stop()
+                if class_name is None:
+                    live_classes = load_live("Classes")
+                    if live_classes is None: st.stop()
+                    valid = set(live_classes['TenLop'].astype(str)) if not live_classes.empty else set()
+                else:
+                    valid = {str(class_name)}  # GVCN chỉ được import vào lớp mình chủ nhiệm
+                existing = set(live_users['Email'].astype(str)) if not live_users.empty else set()
+                new_users, new_rels, rejected = prepare_roster(df_up, existing, class_name or "", valid)
+                ck = {'users': new_users, 'rels': new_rels, 'rejected': rejected, 'users_done': 0, 'rels_done': 0}
+                save_import_checkpoint(key, ck)
+            n_u, n_r = count_chunks(ck['users']), count_chunks(ck['rels'])
+            
+            st.write(f"Hợp lệ: **{len(ck['users'])}** HS, **{len(ck['rels'])}** liên kết PH | Bỏ qua: **{len(ck['rejected'])}** dòng")
+            if not ck['rejected'].empty: st.dataframe(ck['rejected'])
+            
+            if n_u + n_r == 0:
+                st.info("Không có dòng mới để import.")
+                delete_import_checkpoint(key)
+            elif ck['users_done'] >= n_u and ck['rels_done'] >= n_r:
+                st.success(f"Đã thêm {len(ck['users'])} HS!")
+                delete_import_checkpoint(key)
+            else:
+                started = ck['users_done'] > 0 or ck['rels_done'] > 0
+                if st.button("▶️ Tiếp tục import" if started else "▶️ Bắt đầu import"):
+                    total = max(n_u + n_r, 1)
+                    bar = st.progress((ck['users_done'] + ck['rels_done']) / total)
+                    
+                    # Lưu checkpoint sau mỗi lô để có thể chạy tiếp nếu bị ngắt
+                    def on_users(d, n):
+                        ck['users_done'] = d
+                        save_import_checkpoint(key, ck)
+                        bar.progress((d + ck['rels_done']) / total, text=f"Users: lô {d}/{n}")
+                    def on_rels(d, n):
+                        ck['rels_done'] = d
+                        save_import_checkpoint(key, ck)
+                        bar.progress((n_u + d) / total, text=f"Relationships: lô {d}/{n}")
+                    
+                    append_rows_chunked("Users", ck['users'], start_chunk=ck['users_done'], on_progress=on_users)
+                    if ck['users_done'] >= n_u:
+                        append_rows_chunked("Relationships", ck['rels'], start_chunk=ck['rels_done'], on_progress=on_rels)
+                    
+                    if ck['users_done'] >= n_u and ck['rels_done'] >= n_r:
+                        st.success(f"Đã thêm {len(ck['users'])} HS!")
+                        delete_import_checkpoint(key)  # tải lại cùng file sau này -> kiểm tra lại từ đầu
+                    else:
+                        st.warning(f"Tạm dừng ở Users {ck['users_done']}/{n_u}, Relationships {ck['rels_done']}/{n_r} lô. Bấm 'Tiếp tục import' để chạy tiếp.")
+        except Exception as e: st.error(f"Lỗi: {e}")
+
 def get_periods_map(role):
     df = load_data("Periods")
     if df.empty or 'TrangThai' not in df.columns: return {}
@@ -420,42 +1356,24 @@ def admin_dashboard(period_id):
     st.header("🛠️ Admin Dashboard")
     change_password_ui(st.session_state['user']['email'])
     
-    tab1, tab2, tab3 = st.tabs(["Thống kê Lớp", "Quản lý User", "Quản lý Đợt"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Thống kê Lớp", "Quản lý User", "Quản lý Đợt", "Xu hướng"])
     
     with tab1:
         st.subheader(f"📊 Thống kê - Đợt ID: {period_id}")
-        classes = load_data("Classes")
-        
-        if not classes.empty:
-            reviews = load_data("FinalReviews")
-            okrs = load_data("OKRs")
-            users = load_data("Users")
+        frozen = load_frozen_if_locked(period_id)
+        if frozen is not None:
+            show_frozen_results(period_id, frozen)
+        else:
+            classes = load_data("Classes")
             
-            stats = []
-            for _, cl in classes.iterrows():
-                ten_lop = cl.get('TenLop', '')
-                siso = int(cl.get('SiSo', 0))
-                
-                hs_list = []
-                if not users.empty and 'TenLop' in users.columns:
-                    hs_list = users[users['TenLop'] == ten_lop]['Email'].tolist()
-                
-                okr_count = 0
-                approved_count = 0
-                if hs_list:
-                    if not okrs.empty:
-                        okr_count = okrs[(okrs['ID_Dot'] == period_id) & (okrs['Email_HocSinh'].isin(hs_list))].shape[0]
-                    if not reviews.empty:
-                        approved_count = reviews[(reviews['ID_Dot'] == period_id) & (reviews['Email_HocSinh'].isin(hs_list)) & (reviews['NhanXet_GV'] != "")].shape[0]
+            if not classes.empty:
+                reviews = load_data("FinalReviews")
+                okrs = load_okrs(period_id)
+                users = load_data("Users")
                 
-                stats.append({
-                    "Lớp": ten_lop, "GVCN": cl.get('EmailGVCN', ''), "Sĩ số": siso,
-                    "Tổng OKR": okr_count, "HS Đã Duyệt": f"{approved_count}/{len(hs_list)}"
-                })
-            
-            df_stats = pd.DataFrame(stats)
-            st.dataframe(df_stats)
-            if not df_stats.empty: st.bar_chart(df_stats.set_index("Lớp")[["Tổng OKR"]])
+                df_stats = compute_class_stats(period_id, classes, users, okrs, reviews)
+                st.dataframe(df_stats)
+                if not df_stats.empty: st.bar_chart(df_stats.set_index("Lớp")[["Tổng OKR"]])
 
         st.divider()
         with st.form("create_class"):
@@ -466,8 +1384,8 @@ def admin_dashboard(period_id):
             if st.form_submit_button("Tạo Lớp"):
                 try:
                     batch_add_records("Classes", [[name, gv, ss]])
-                    all_u = load_data("Users")
-                    if all_u.empty or gv not in all_u['Email'].values:
+                    all_u = load_live("Users")
+                    if all_u is not None and (all_u.empty or gv not in all_u['Email'].astype(str).values):
                         batch_add_records("Users", [[gv, "123", f"GV {name}", "GiaoVien", ""]])
                     st.success("Xong!")
                     st.rerun()
@@ -484,6 +1402,11 @@ def admin_dashboard(period_id):
                     update_cell_value("Users", "Email", search, "Password", "123")
                     st.success("Đã reset.")
 
+        st.divider()
+        with st.expander("📥 Import HS nhiều lớp (Excel)"):
+            st.caption("Cột bắt buộc: Email, HoTen, TenLop (phải có trong danh sách lớp). Tuỳ chọn: EmailPH.")
+            roster_import_ui()
+
     with tab3:
         periods = load_data("Periods")
         for _, row in periods.iterrows():
@@ -491,20 +1414,62 @@ def admin_dashboard(period_id):
             is_open = row.get('TrangThai') == 'Mo'
             p_id = row.get('ID')
             p_name = row.get('TenDot', '')
-            toggle = c1.toggle(f"{p_name}", value=is_open, key=f"p_{p_id}")
+            toggle = c1.toggle(f"{p_name}" + (" ❄️" if is_frozen(p_id) else ""), value=is_open, key=f"p_{p_id}")
             if toggle != is_open:
-                update_cell_value("Periods", "ID", p_id, "TrangThai", "Mo" if toggle else "Khoa")
+                if update_cell_value("Periods", "ID", p_id, "TrangThai", "Mo" if toggle else "Khoa"):
+                    if toggle: unfreeze_period(p_id)
+                    else:
+                        with st.spinner("Đang chốt kết quả đợt..."):
+                            freeze_period(p_id, p_name)
                 st.rerun()
+            if not is_open and not is_frozen(p_id) and c1.button("❄️ Chốt kết quả", key=f"frz_p_{p_id}") and not blocked_by_read_only():
+                with st.spinner("Đang chốt kết quả đợt..."):
+                    frozen = freeze_period(p_id, p_name)
+                if frozen: st.rerun()
+                st.error("Chưa chốt được: không đọc được dữ liệu mới nhất từ Google Sheets, vui lòng thử lại.")
             if c2.button("🗑️", key=f"del_p_{p_id}"):
                 delete_record("Periods", "ID", p_id)
+                unfreeze_period(p_id)
                 st.rerun()
         
         with st.form("add_p"):
             pn = st.text_input("Tên đợt")
             if st.form_submit_button("Thêm"):
                 nid = get_next_id("Periods")
-                batch_add_records("Periods", [[nid, pn, "Mo"]])
+                if nid is not None and batch_add_records("Periods", [[nid, pn, "Mo"]]):
+                    create_okr_partition(nid)
                 st.rerun()
+        
+        if OKR_SHEET in (sheet_titles() or []):
+            with st.expander("🗂️ Tách bảng OKRs theo đợt"):
+                st.caption(f"Chuyển dữ liệu từ bảng '{OKR_SHEET}' sang các bảng '{OKR_SHEET}_<ID đợt>'. Bảng cũ được đổi tên thành bản sao lưu. Có thể chạy lại nếu bị dừng giữa chừng.")
+                if st.button("Bắt đầu tách"):
+                    bar = st.progress(0.0)
+                    try:
+                        moved = migrate_okrs_to_partitions(on_progress=lambda d, n: bar.progress(d / n, text=f"Đợt {d}/{n}"))
+                        st.success(f"Đã tách {sum(moved.values())} OKR vào {len(moved)} phân vùng.")
+                    except Exception as e: st.error(f"Lỗi: {e}")
+
+    with tab4:
+        prog = load_progress()
+        c1, c2 = st.columns([4, 1])
+        c1.caption(f"Bảng tổng hợp: {len(prog)} dòng (HS x đợt), cập nhật tự động khi OKR/nhận xét thay đổi.")
+        if c2.button("🔄 Tính lại toàn bộ"):
+            with st.spinner("Đang tính lại..."):
+                n = rebuild_progress()
+            st.success(f"Đã tính lại {n} dòng.")
+            st.rerun()
+        school = summarize_progress(prog, ['ID_Dot', 'TenDot'])
+        if school.empty:
+            st.info("Chưa có dữ liệu tổng hợp.")
+        else:
+            st.write("###### Toàn trường theo đợt")
+            st.dataframe(school.drop(columns=['ID_Dot']), hide_index=True)
+            by_class = summarize_progress(prog, ['TenLop', 'ID_Dot'])
+            st.write("###### % hoàn thành trung bình theo lớp")
+            st.line_chart(by_class.pivot(index='ID_Dot', columns='TenLop', values='TrungBinh'))
+            # Khóa theo ID_Dot (tên đợt có thể trùng), đổi nhãn cột sau khi pivot
+            st.dataframe(by_class.pivot(index='TenLop', columns='ID_Dot', values='TrungBinh').rename(columns=period_labels(prog)))
 
 # --- TEACHER ---
 def teacher_dashboard(period_id):
@@ -523,7 +1488,8 @@ def teacher_dashboard(period_id):
 
     # Load All Data Once
     users = load_data("Users")
-    all_okrs = load_data("OKRs")
+    okr_sheet = resolve_okr_sheet(period_id)
+    all_okrs = load_okrs(period_id)
     all_reviews = load_data("FinalReviews")
     students = users[users['TenLop'] == class_name] if not users.empty and 'TenLop' in users.columns else pd.DataFrame()
 
@@ -548,9 +1514,7 @@ def teacher_dashboard(period_id):
         m3.metric("Tỉ lệ", f"{round(submitted/total_hs*100, 1) if total_hs else 0}%")
         with m4:
             if submitted > 0:
-                fig, ax = plt.subplots(figsize=(2, 2))
-                ax.pie(list(ranks.values()), labels=list(ranks.keys()), autopct='%1.0f%%', textprops={'fontsize': 6})
-                st.pyplot(fig)
+                show_rank_chart(class_name, period_id, ranks)
     st.divider()
 
     # --- REPORT EXPORT ---
@@ -560,11 +1524,16 @@ def teacher_dashboard(period_id):
         p_row = p_df[p_df['ID'] == period_id]
         if not p_row.empty: period_name = p_row.iloc[0]['TenDot']
     
-    docx_class = create_class_report_docx(class_name, students, all_okrs, all_reviews, period_name, period_id)
-    st.download_button("📥 XUẤT BÁO CÁO CẢ LỚP (.docx)", data=docx_class, file_name=f"BaoCaoLop_{class_name}.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+    prebuilt = load_prebuilt_report(period_id, class_name)
+    if prebuilt:
+        st.download_button(f"📥 BÁO CÁO CẢ LỚP - bản dựng sẵn lúc {time.strftime('%d/%m %H:%M', time.localtime(prebuilt[1]))}",
+                           data=prebuilt[0], file_name=f"BaoCaoLop_{class_name}.docx", mime=DOCX_MIME, key="dl_prebuilt")
+    report_download_button("📥 XUẤT BÁO CÁO CẢ LỚP (.docx)", f"class_{class_name}_{period_id}",
+                           lambda: create_class_report_docx(class_name, students, all_okrs, all_reviews, period_name, period_id),
+                           f"BaoCaoLop_{class_name}.docx")
     st.divider()
 
-    tab1, tab2 = st.tabs(["Danh sách & Duyệt", "Quản lý HS (Thêm/Import)"])
+    tab1, tab2, tab3 = st.tabs(["Danh sách & Duyệt", "Quản lý HS (Thêm/Import)", "📈 Xu hướng lớp"])
 
     with tab1: # LIST
         if students.empty:
@@ -645,30 +1614,35 @@ def teacher_dashboard(period_id):
                         rev_gv = r_row.iloc[0]['NhanXet_GV']
                         rev_ph = r_row.iloc[0]['NhanXet_PH']
 
-                docx_single = create_single_docx(curr['HoTen'], class_name, period_name, hs_okrs, rev_gv, rev_ph)
-                st.download_button("📥 Tải phiếu kết quả (Word)", data=docx_single, file_name=f"KQ_{curr['HoTen']}.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+                report_download_button("📥 Tải phiếu kết quả (Word)", f"hs_{curr['Email']}_{period_id}",
+                                       lambda: create_single_docx(curr['HoTen'], class_name, period_name, hs_okrs, rev_gv, rev_ph),
+                                       f"KQ_{curr['HoTen']}.docx")
 
                 # OKR Items
                 if hs_okrs.empty:
                     st.warning("Chưa có OKR.")
                 else:
+                    # Minh chứng nằm ở cột văn bản tách riêng -> chỉ đọc khi xem chi tiết
+                    okr_texts = load_text_columns(okr_sheet)
+                    evidence = dict(zip(okr_texts['ID'], okr_texts['MinhChung'])) if 'MinhChung' in okr_texts.columns else {}
                     for i, row in hs_okrs.iterrows():
                         with st.container(border=True):
                             c1, c2, c3 = st.columns([4, 2, 2])
                             if row['DeleteRequest'] == 1: st.error("⚠️ Yêu cầu xóa")
                             c1.markdown(f"**O:** {row['MucTieu']}")
                             c1.text(f"KR: {row['KetQuaThenChot']}")
+                            if evidence.get(row['ID']): c1.caption(f"📎 Minh chứng: {evidence[row['ID']]}")
                             c2.metric("Target/Actual", f"{row['TargetValue']} / {row['ActualValue']} {row['Unit']}")
                             pct = calculate_percent(row['ActualValue'], row['TargetValue'])
                             c2.progress(min(pct/100, 1.0))
                             with c3:
                                 if row['TrangThai'] == 'ChoDuyet':
                                     if st.button("✅ Duyệt", key=f"a_{row['ID']}"):
-                                        update_cell_value("OKRs", "ID", row['ID'], "TrangThai", "DaDuyetMucTieu")
+                                        update_cell_value(okr_sheet, "ID", row['ID'], "TrangThai", "DaDuyetMucTieu")
                                         st.rerun()
                                 if row['DeleteRequest'] == 1:
                                     if st.button("🗑️ Chấp thuận xóa", key=f"d_{row['ID']}"):
-                                        delete_record("OKRs", "ID", row['ID'])
+                                        delete_record(okr_sheet, "ID", row['ID'])
                                         st.rerun()
 
                     st.write("---")
@@ -688,39 +1662,35 @@ def teacher_dashboard(period_id):
             n_email = c2.text_input("Email")
             if st.form_submit_button("Thêm HS"):
                 if n_name and n_email:
-                    existing = set(users['Email'].tolist()) if not users.empty else set()
-                    if n_email in existing:
-                        st.error("Email đã tồn tại!")
-                    else:
-                        batch_add_records("Users", [[n_email, "123", n_name, "HocSinh", class_name]])
-                        st.success("Đã thêm!")
-                        st.rerun()
+                    live_users = load_live("Users")
+                    if live_users is not None:
+                        if n_email in set(live_users['Email'].astype(str)):
+                            st.error("Email đã tồn tại!")
+                        else:
+                            batch_add_records("Users", [[n_email, "123", n_name, "HocSinh", class_name]])
+                            st.success("Đã thêm!")
+                            st.rerun()
 
         st.divider()
         # 2. Batch Import
         with st.expander("📥 Import Excel (Batch Upload - Chống lỗi 429)"):
-            upl = st.file_uploader("Chọn file .xlsx", type=['xlsx'])
-            if upl:
-                try:
-                    df_up = pd.read_excel(upl)
-                    existing = set(users['Email'].tolist()) if not users.empty else set()
-                    new_users, new_rels = [], []
-                    count = 0
-                    for _, r in df_up.iterrows():
-                        e = str(r['Email']).strip()
-                        n = str(r['HoTen']).strip()
-                        if e and e not in existing:
-                            new_users.append([e, "123", n, "HocSinh", class_name])
-                            existing.add(e)
-                            count += 1
-                            if 'EmailPH' in r and pd.notna(r['EmailPH']):
-                                ph = str(r['EmailPH']).strip()
-                                new_rels.append([e, ph])
-                    
-                    if new_users: batch_add_records("Users", new_users)
-                    if new_rels: batch_add_records("Relationships", new_rels)
-                    st.success(f"Đã thêm {count} HS!")
-                except Exception as e: st.error(f"Lỗi: {e}")
+            st.caption("Cột bắt buộc: Email, HoTen. Tuỳ chọn: EmailPH, TenLop (để trống = lớp hiện tại; chỉ nhận lớp của bạn).")
+            roster_import_ui(class_name)
+
+    with tab3: # Trend (chỉ đọc bảng tổng hợp)
+        prog = load_progress()
+        prog = prog[prog['TenLop'] == class_name]
+        trend = summarize_progress(prog, ['ID_Dot', 'TenDot'])
+        if trend.empty:
+            st.info("Chưa có dữ liệu tổng hợp cho lớp.")
+        else:
+            st.line_chart(trend.set_index('ID_Dot')[['TrungBinh', 'TiLeDuyet']])
+            st.dataframe(trend.drop(columns=['ID_Dot']), hide_index=True)
+            st.write("###### % hoàn thành từng học sinh")
+            names = dict(zip(students['Email'].astype(str), students['HoTen'])) if not students.empty else {}
+            per_hs = prog.assign(HoTen=prog['Email_HocSinh'].map(names).fillna(prog['Email_HocSinh']))
+            st.dataframe(per_hs.pivot_table(index='HoTen', columns='ID_Dot', values='TrungBinh', aggfunc='first')
+                         .rename(columns=period_labels(prog)))
 
 # --- STUDENT ---
 def student_dashboard(period_id):
@@ -728,6 +1698,7 @@ def student_dashboard(period_id):
     st.header(f"🎒 {user['name']}")
     change_password_ui(user['email'])
     
+    okr_sheet = resolve_okr_sheet(period_id)
     with st.expander("➕ Thêm OKR"):
         with st.form("add_okr"):
             mt = st.text_input("Mục tiêu")
@@ -736,12 +1707,13 @@ def student_dashboard(period_id):
             tar = c1.number_input("Target", 0.1)
             unit = c2.text_input("Đơn vị", "Điểm")
             if st.form_submit_button("Lưu"):
-                nid = get_next_id("OKRs")
-                batch_add_records("OKRs", [[nid, user['email'], period_id, mt, kr, 0, 'ChoDuyet', '', '', '', tar, 0, unit, 0]])
-                st.rerun()
+                nid = get_next_id(okr_sheet)
+                if nid is not None:
+                    batch_add_records(okr_sheet, [[nid, user['email'], period_id, mt, kr, 0, 'ChoDuyet', '', '', '', tar, 0, unit, 0]])
+                    st.rerun()
 
     st.divider()
-    all_okrs = load_data("OKRs")
+    all_okrs = load_okrs(period_id)
     my_okrs = all_okrs[(all_okrs['Email_HocSinh'] == user['email']) & (all_okrs['ID_Dot'] == period_id)] if not all_okrs.empty else pd.DataFrame()
     
     if my_okrs.empty:
@@ -761,15 +1733,15 @@ def student_dashboard(period_id):
                         with st.form(f"u_{row['ID']}"):
                             val = st.number_input("Đạt:", value=float(row['ActualValue']))
                             if st.form_submit_button("Lưu"):
-                                update_cell_value("OKRs", "ID", row['ID'], "ActualValue", val)
+                                update_cell_value(okr_sheet, "ID", row['ID'], "ActualValue", val)
                                 st.rerun()
                     if row['TrangThai'] == 'ChoDuyet':
                         if st.button("🗑️ Xóa", key=f"d_{row['ID']}"):
-                            delete_record("OKRs", "ID", row['ID'])
+                            delete_record(okr_sheet, "ID", row['ID'])
                             st.rerun()
                     elif row['DeleteRequest'] == 0:
                         if st.button("❌ Xin xóa", key=f"r_{row['ID']}"):
-                            update_cell_value("OKRs", "ID", row['ID'], "DeleteRequest", 1)
+                            update_cell_value(okr_sheet, "ID", row['ID'], "DeleteRequest", 1)
                             st.rerun()
 
     st.divider()
@@ -794,13 +1766,23 @@ def student_dashboard(period_id):
         pr = p_df[p_df['ID'] == period_id]
         if not pr.empty: p_name = pr.iloc[0]['TenDot']
 
-    docx = create_single_docx(user['name'], my_class, p_name, my_okrs, rev_gv, rev_ph)
-    st.download_button("📥 Tải kết quả về máy", data=docx, file_name=f"KQ_{user['name']}.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+    report_download_button("📥 Tải kết quả về máy", f"me_{period_id}",
+                           lambda: create_single_docx(user['name'], my_class, p_name, my_okrs, rev_gv, rev_ph),
+                           f"KQ_{user['name']}.docx")
 
     c1, c2 = st.columns(2)
     c1.info(f"Giáo viên: {rev_gv}")
     c2.success(f"Gia đình: {rev_ph}")
 
+    with st.expander("📈 Tiến bộ qua các đợt"):
+        prog = load_progress()
+        mine = prog[(prog['Email_HocSinh'] == user['email']) & (prog['SoOKR'] > 0)].sort_values('ID_Dot')
+        if mine.empty:
+            st.info("Chưa có dữ liệu.")
+        else:
+            st.line_chart(mine.set_index('ID_Dot')[['TrungBinh', 'TiLeDuyet']])
+            st.dataframe(mine[['TenDot', 'SoOKR', 'TrungBinh', 'XepLoai', 'TiLeDuyet']], hide_index=True)
+
 # --- PARENT ---
 def parent_dashboard(period_id):
     user = st.session_state['user']
@@ -814,7 +1796,7 @@ def parent_dashboard(period_id):
         return
         
     child_email = my_child.iloc[0]['Email_HocSinh']
-    all_okrs = load_data("OKRs")
+    all_okrs = load_okrs(period_id)
     df_okr = all_okrs[(all_okrs['Email_HocSinh'] == child_email) & (all_okrs['ID_Dot'] == period_id)] if not all_okrs.empty else pd.DataFrame()
     
     if not df_okr.empty:
@@ -846,6 +1828,8 @@ def main():
             if st.button("Đăng xuất"):
                 del st.session_state['user']
                 st.rerun()
+            if is_read_only():
+                st.warning("⚠️ Mất kết nối Google Sheets - đang hiển thị dữ liệu lưu tạm (chỉ đọc).")
             st.divider()
             
             periods = load_data("Periods")
@@ -855,7 +1839,7 @@ def main():
                 if not periods.empty:
                     p_map = dict(zip(periods['TenDot'], periods['ID']))
                     p_name = st.selectbox("Chọn Đợt", list(p_map.keys()))
-                    p_id = p_map[p_name]
+                    p_id = int(p_map[p_name])
                 else: st.warning("Chưa có đợt hoạt động.")
 
         if p_id:
@@ -0,0 +1,285 @@
+"""Chạy các tác vụ nặng ngoài Streamlit (cron / ngoài giờ).
+
+Ví dụ:
+    python jobs.py snapshot stats reports
+    python jobs.py --credentials key.json --workers 4 --rate 50 reports --period 3
+    python jobs.py --backend local --data-dir ./sample_data stats
+
+Kết quả được ghi vào các thư mục mà dashboard đọc trực tiếp:
+    snapshot -> SNAPSHOT_DIR (khởi động nhanh / chế độ chỉ đọc)
+    stats    -> AGG_DIR (trang Xu hướng) + FROZEN_DIR (đợt đã khóa)
+    reports  -> JOBS_DIR/reports (nút tải "bản dựng sẵn" của giáo viên)
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Import app.py ở chế độ "bare" (không có Streamlit runtime) -> tắt cảnh báo của Streamlit
+import streamlit.logger  # noqa: E402
+streamlit.logger.set_log_level("error")
+import app  # noqa: E402
+
+
+def log(msg):
+    print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
+
+
+# ==============================================================================
+# GIỚI HẠN TỐC ĐỘ GỌI API
+# ==============================================================================
+class RateLimiter:
+    """Giãn cách các lần gọi API để không vượt quota (số request / phút), dùng chung giữa các luồng"""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next_at - now)
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay: time.sleep(delay)
+
+
+def pace_requests(client, limiter):
+    """Giãn cách ở tầng HTTP của gspread: mọi request tới Sheets API (mở file, metadata worksheet,
+    đọc/ghi giá trị, danh sách worksheet...) đều đi qua limiter -> --rate là số request thật mỗi phút.
+    (Một lần fetch_sheet = 3 request: open_by_key, worksheet, get_all_records.)"""
+    http = getattr(client, "http_client", None)
+    if http is None: return  # backend CSV: không gọi API
+    request = http.request
+
+    def paced_request(*a, **kw):
+        limiter.wait()
+        return request(*a, **kw)
+    http.request = paced_request
+
+
+# ==============================================================================
+# BACKEND GIẢ LẬP (THƯ MỤC CSV) - DÙNG ĐỂ TEST / CHẠY THỬ
+# ==============================================================================
+def _numericise(v):
+    """Giống gspread.get_all_records: chuỗi số -> int/float"""
+    if isinstance(v, str) and v.strip():
+        try: return int(v)
+        except ValueError: pass
+        try: return float(v)
+        except ValueError: pass
+    return v
+
+
+class LocalCell:
+    def __init__(self, row, col, value):
+        self.row, self.col, self.value = row, col, value
+
+
+class LocalWorksheet:
+    """Phần giao diện gspread.Worksheet mà app.py dùng, lưu trong bộ nhớ"""
+
+    def __init__(self, book, title, rows=None):
+        self.book, self.title, self.rows = book, title, rows or []
+
+    def get_all_values(self, **kwargs):
+        return [[str(v) for v in r] for r in self.rows]
+
+    def get_all_records(self):
+        if not self.rows: return []
+        header = self.rows[0]
+        return [{h: _numericise(r[i] if i < len(r) else "") for i, h in enumerate(header)} for r in self.rows[1:]]
+
+    def row_values(self, row):
+        return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def col_values(self, col):
+        return [str(r[col - 1]) if col <= len(r) else "" for r in self.rows]
+
+    def append_row(self, values, **kwargs):
+        self.rows.append(list(values))
+
+    def append_rows(self, values, **kwargs):
+        self.rows.extend(list(v) for v in values)
+
+    def update_cell(self, row, col, value):
+        r = self.rows[row - 1]
+        r.extend([""] * (col - len(r)))
+        r[col - 1] = value
+
+    def update_cells(self, cells):
+        for c in cells: self.update_cell(c.row, c.col, c.value)
+
+    def findall(self, query, in_column=None):
+        return [LocalCell(i + 1, j + 1, v) for i, r in enumerate(self.rows) for j, v in enumerate(r)
+                if str(v) == str(query) and (in_column is None or in_column == j + 1)]
+
+    def find(self, query, in_column=None):
+        cells = self.findall(query, in_column)
+        return cells[0] if cells else None
+
+    def delete_rows(self, row):
+        del self.rows[row - 1]
+
+    def update_title(self, title):
+        self.book.sheets[title] = self.book.sheets.pop(self.title)
+        self.title = title
+
+
+class LocalSpreadsheet:
+    def __init__(self):
+        self.sheets = {}
+
+    def worksheet(self, title):
+        import gspread
+        if title not in self.sheets: raise gspread.WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def add_worksheet(self, title, rows=100, cols=20):
+        self.sheets[title] = LocalWorksheet(self, title)
+        return self.sheets[title]
+
+    def worksheets(self):
+        return list(self.sheets.values())
+
+
+class LocalSheetsClient:
+    """Thay cho gspread client: mỗi file <TênSheet>.csv trong data_dir là một worksheet"""
+
+    def __init__(self, data_dir=None):
+        self.book = LocalSpreadsheet()
+        if data_dir:
+            for fn in sorted(os.listdir(data_dir)):
+                if fn.endswith(".csv"):
+                    with open(os.path.join(data_dir, fn), newline="", encoding="utf-8") as f:
+                        self.book.sheets[fn[:-4]] = LocalWorksheet(self.book, fn[:-4], [list(r) for r in csv.reader(f)])
+
+    def open_by_key(self, key):
+        return self.book
+
+
+def use_backend(args):
+    """Gắn client (Google thật hoặc CSV giả lập) vào app.init_connection"""
+    if args.backend == "local":
+        client = LocalSheetsClient(args.data_dir)
+    elif args.credentials:
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
+        scope = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
+        client = gspread.authorize(ServiceAccountCredentials.from_json_keyfile_name(args.credentials, scope))
+    else:
+        client = app.init_connection()  # đọc .streamlit/secrets.toml như app
+    if client is None: raise SystemExit("Không kết nối được Google Sheets.")
+    app.init_connection = lambda: client
+    # Job luôn đọc dữ liệu live, không trả snapshot cũ
+    app.get_runtime_state()['live_only'] = True
+    return client
+
+
+# ==============================================================================
+# CÁC JOB
+# ==============================================================================
+def job_snapshot(args):
+    """Đọc lại mọi bảng (gồm phân vùng OKRs) và ghi snapshot; tuỳ chọn sao chép ra --export"""
+    names = [n for n in app.SHEET_HEADERS if n != app.OKR_SHEET] + app.list_okr_sheets()
+    with ThreadPoolExecutor(max_workers=args.workers) as ex:
+        frames = dict(zip(names, ex.map(app.fetch_sheet, names)))
+    failed = [n for n, df in frames.items() if df is None]
+    for n, df in frames.items():
+        if df is not None: app.save_snapshot(n, df)
+    if args.export:
+        os.makedirs(args.export, exist_ok=True)
+        for n in frames:
+            for path in app._snapshot_paths(n):
+                if os.path.exists(path): shutil.copy2(path, args.export)
+    log(f"snapshot: {len(names) - len(failed)}/{len(names)} bảng" + (f", lỗi: {', '.join(failed)}" if failed else ""))
+    return not failed
+
+
+def job_stats(args):
+    """Tính lại bảng tổng hợp tiến bộ & chốt kết quả các đợt đã khóa chưa được chốt"""
+    n = app.rebuild_progress()
+    log(f"stats: {n} dòng tổng hợp")
+
+    periods = app.load_data("Periods")
+
+    if not periods.empty:
+        locked = periods[periods['TrangThai'].astype(str) == 'Khoa']
+        for _, p in locked.iterrows():
+            if not app.is_frozen(p['ID']):
+                ok = app.freeze_period(int(p['ID']), p['TenDot'])
+                log(f"stats: chốt đợt {p['ID']} ({p['TenDot']}): {'xong' if ok else 'lỗi'}")
+    return True
+
+
+def job_reports(args):
+    """Dựng báo cáo Word cho mọi lớp của các đợt đang mở (hoặc --period), song song có giới hạn"""
+    periods = app.load_data("Periods")
+    if periods.empty:
+        log("reports: chưa có đợt")
+        return True
+    if args.period is not None: periods = periods[periods['ID'] == args.period]
+    else: periods = periods[periods['TrangThai'].astype(str) == 'Mo']
+
+    classes, users, reviews = (app.load_data(n) for n in ("Classes", "Users", "FinalReviews"))
+    class_names = classes['TenLop'].astype(str).tolist() if not classes.empty else []
+
+    for _, p in periods.iterrows():
+        pid, pname = int(p['ID']), p['TenDot']
+        okrs = app.load_okrs(pid)
+        build = lambda cname: app.create_class_report_docx(cname, users[users['TenLop'] == cname], okrs, reviews, pname, pid)
+        with ThreadPoolExecutor(max_workers=args.workers) as ex:
+            docs = dict(zip(class_names, ex.map(build, class_names)))
+
+        # Ghi vào thư mục tạm rồi thay thế -> dashboard không bao giờ đọc bản dở dang
+        final_dir = app.prebuilt_reports_dir(pid)
+        tmp_dir = f"{final_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        reports = {}
+        for i, (cname, data) in enumerate(docs.items()):
+            reports[cname] = f"class_{i}.docx"
+            with open(os.path.join(tmp_dir, reports[cname]), "wb") as f: f.write(data)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump({"period_id": pid, "period_name": str(pname), "generated_at": time.time(), "reports": reports}, f, ensure_ascii=False)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+        log(f"reports: đợt {pid} ({pname}): {len(reports)} lớp -> {final_dir}")
+    return True
+
+
+JOBS = {"snapshot": job_snapshot, "stats": job_stats, "reports": job_reports}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch job cho hệ thống OKR (không cần giao diện).")
+    parser.add_argument("jobs", nargs="+", choices=list(JOBS), help="Các job cần chạy, theo thứ tự")
+    parser.add_argument("--backend", choices=["sheets", "local"], default="sheets")
+    parser.add_argument("--data-dir", help="Thư mục CSV cho --backend local")
+    parser.add_argument("--credentials", help="File JSON service account (mặc định: .streamlit/secrets.toml)")
+    parser.add_argument("--workers", type=int, default=4, help="Số luồng song song tối đa")
+    parser.add_argument("--rate", type=float, default=50, help="Số request Sheets API tối đa mỗi phút (quota đọc mặc định: 60/phút/người dùng)")
+    parser.add_argument("--period", type=int, help="reports: chỉ dựng cho đợt này")
+    parser.add_argument("--export", help="snapshot: sao chép snapshot ra thư mục này")
+    args = parser.parse_args(argv)
+
+    client = use_backend(args)
+    pace_requests(client, RateLimiter(args.rate))
+    ok = True
+    for name in args.jobs:
+        started = time.time()
+        try:
+            ok = JOBS[name](args) and ok
+        except Exception as e:
+            log(f"{name}: lỗi {e}")
+            ok = False
+        log(f"{name}: {time.time() - started:.1f}s")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Cho phép `import app` / `import jobs` từ thư mục gốc của repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,96 @@
+"""Chạy jobs.py trên backend CSV (tests/fixtures/school), kiểm tra các file mà dashboard đọc.
+
+Dữ liệu mẫu: đợt 1 (HK1) đã khóa, đợt 2 (HK2) đang mở; 2 lớp, mỗi lớp 1 học sinh.
+"""
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import jobs
+import app
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "school")
+SHEETS = ["Users", "Classes", "Periods", "Relationships", "FinalReviews", "OKRs_1", "OKRs_2"]
+DIRS = {"OKR_SNAPSHOT_DIR": "SNAPSHOT_DIR", "OKR_FROZEN_DIR": "FROZEN_DIR",
+        "OKR_AGG_DIR": "AGG_DIR", "OKR_JOBS_DIR": "JOBS_DIR", "OKR_IMPORT_DIR": "IMPORT_CKPT_DIR"}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Mọi thư mục dữ liệu cục bộ nằm trong tmp_path; khôi phục các hàm mà jobs.py ghi đè"""
+    monkeypatch.chdir(tmp_path)
+    for env, attr in DIRS.items():
+        path = str(tmp_path / env.lower())
+        monkeypatch.setenv(env, path)
+        monkeypatch.setattr(app, attr, path)  # app.py đọc biến môi trường lúc import
+    monkeypatch.setattr(app, "OKR_MIGRATION_LOCK", str(tmp_path / "okr_snapshot_dir" / "okr_migration.lock"))
+    monkeypatch.setattr(app, "init_connection", app.init_connection)
+    monkeypatch.setattr(app, "fetch_sheet", app.fetch_sheet)
+    state = app.get_runtime_state()
+    monkeypatch.setitem(state, "live_only", state["live_only"])
+    state["warm"].clear()
+    app.st.cache_data.clear()
+    return tmp_path
+
+
+def run(*argv):
+    return jobs.main(["--backend", "local", "--data-dir", FIXTURE_DIR, *argv])
+
+
+def read_manifest(path):
+    with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_snapshot_stats_reports(workdir):
+    assert run("snapshot", "stats", "reports") == 0
+
+    # snapshot: mọi bảng (kể cả phân vùng OKRs) đều đọc lại được
+    for name in SHEETS:
+        assert all(os.path.exists(p) for p in app._snapshot_paths(name))
+    assert len(app.load_snapshot("Users")) == 2
+    assert sorted(app.load_snapshot("OKRs_2")["Email_HocSinh"].astype(str)) == ["a@x", "b@x"]
+
+    # stats: bảng tổng hợp = số HS x số đợt
+    prog = pd.read_parquet(os.path.join(app.AGG_DIR, "progress.parquet"))
+    assert len(prog) == 4
+    row = prog[(prog["Email_HocSinh"] == "a@x") & (prog["ID_Dot"] == 1)].iloc[0]
+    assert (row["TrungBinh"], row["XepLoai"], bool(row["DaNhanXet_GV"])) == (80.0, "Tốt", True)
+    assert prog[(prog["Email_HocSinh"] == "b@x") & (prog["ID_Dot"] == 2)].iloc[0]["TrungBinh"] == 100.0
+
+    # stats: chỉ chốt đợt đã khóa
+    assert app.is_frozen(1) and not app.is_frozen(2)
+    frozen_dir = app._frozen_dir(1)
+    meta = read_manifest(frozen_dir)
+    assert (meta["period_id"], meta["period_name"], meta["students"]) == (1, "HK1", 2)
+    assert set(meta["reports"]) == {"10A1", "10A2"}
+    for file_name in meta["reports"].values():
+        assert os.path.getsize(os.path.join(frozen_dir, "reports", file_name)) > 0
+    students = pd.read_parquet(os.path.join(frozen_dir, "students.parquet"))
+    assert dict(zip(students["Email"].astype(str), students["TrungBinh"])) == {"a@x": 80.0, "b@x": 0.0}
+
+    # reports: mặc định chỉ dựng cho đợt đang mở
+    assert not os.path.exists(app.prebuilt_reports_dir(1))
+    reports_dir = app.prebuilt_reports_dir(2)
+    meta = read_manifest(reports_dir)
+    assert (meta["period_id"], meta["period_name"]) == (2, "HK2")
+    assert set(meta["reports"]) == {"10A1", "10A2"}
+    assert app.load_prebuilt_report(2, "10A1") is not None
+    assert os.listdir(os.path.dirname(reports_dir)) == ["period_2"]  # không còn thư mục tạm
+
+
+def test_reports_for_one_period(workdir):
+    assert run("reports", "--period", "1") == 0
+    assert set(read_manifest(app.prebuilt_reports_dir(1))["reports"]) == {"10A1", "10A2"}
+    assert not os.path.exists(app.prebuilt_reports_dir(2))
+    # Không chạy stats -> không chốt đợt nào
+    assert not app.is_frozen(1)
+
+
+def test_data_dirs_do_not_depend_on_cwd():
+    # cron chạy `python /srv/app/jobs.py` từ thư mục khác -> vẫn phải ghi vào thư mục dashboard đọc
+    for attr in DIRS.values():
+        assert os.path.isabs(getattr(app, attr))
+    assert app.APP_DIR == os.path.dirname(os.path.abspath(app.__file__))